@@ -9,8 +9,15 @@
 
 from __future__ import annotations
 
+import argparse
+import contextlib
+import functools
+import math
 import os
+import shutil
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 import netCDF4 as nc
 import numpy as np
@@ -22,9 +29,25 @@ import pprint
 #     check_time_res,
 #     check_coords,
 #     get_filelist_command,
-#     get_dates,
-#     find_nearest,
+#     get_granule_table,
+#     filter_granules,
+#     build_opendap_urls,
+#     find_nearest_indices,
+#     group_points,
+#     get_grid,
+#     get_subset_indices,
+#     get_cache_path,
+#     record_throughput,
+#     get_recent_throughput,
+#     THROUGHPUT_LOG,
+#     CACHE_DIR,
+#     acquire_lock,
+#     release_lock,
+#     clean_cache,
 #     get_dataset_keys,
+#     qc_chl,
+#     process_chl,
+#     CHL_FILL_VALUE,
 # )
 
 from utilities import (
@@ -33,9 +56,25 @@ from utilities import (
     check_time_res,
     check_coords,
     get_filelist_command,
-    get_dates,
-    find_nearest,
+    get_granule_table,
+    filter_granules,
+    build_opendap_urls,
+    find_nearest_indices,
+    group_points,
+    get_grid,
+    get_subset_indices,
+    get_cache_path,
+    record_throughput,
+    get_recent_throughput,
+    THROUGHPUT_LOG,
+    CACHE_DIR,
+    acquire_lock,
+    release_lock,
+    clean_cache,
     get_dataset_keys,
+    qc_chl,
+    process_chl,
+    CHL_FILL_VALUE,
 )
 
 
@@ -69,7 +108,7 @@ def get_opendap_urls(
     dataset_urls : list
         list of urls for data access via opendap.
     """
-    global dataset_urls, source, variable  # this here so save_dataset can have access to these variables
+    global dataset_urls, granules, source, variable  # this here so save_dataset can have access to these variables
 
     opendap_base_url = "http://oceandata.sci.gsfc.nasa.gov/opendap/MODISA/"
     level = "L3"
@@ -95,30 +134,44 @@ def get_opendap_urls(
     with open(f"{datadir}/filelist.txt", mode="r") as f:
         file_list = list(f)
 
-    filenames = []
-    for file in file_list:
-        filenames.append(file.strip("\n"))
+    filenames = [file.strip() for file in file_list if file.strip()]
     del file_list
+    if len(filenames) == 0 or filenames[0] == "No Results Found":
+        print("## -- No files found for the requested settings. Terminating script. ##")
+        sys.exit()
 
-    # get dates for each file on the list in order to build opendap urls
-    yeari, monthi, dayi, yearf, monthf, dayf = get_dates(filenames)
+    # parse all the filenames once into a granule table (start, end, period),
+    # which is reused for filtering, sorting, de-duplicating and building urls
+    granules = get_granule_table(filenames)
+    granules = filter_granules(granules, date_min, date_max)
 
     # build opendap urls
-    dataset_urls = []
-    for k in range(len(yeari)):
-        url = (
-            f"{opendap_base_url}{level}SMI/{yeari[k]}/{monthi[k]}{dayi[k]}/"
-            f"{source}.{yeari[k]}{monthi[k]}{dayi[k]}_{yearf[k]}{monthf[k]}{dayf[k]}."
-            f"{level}{map_bin}.{time_res}.{variable}.chlor_a.{space_res}.nc"
-        )
-        dataset_urls.append(url)
+    dataset_urls = build_opendap_urls(
+        granules,
+        space_res,
+        opendap_base_url=opendap_base_url,
+        level=level,
+        map_bin=map_bin,
+        source=source,
+        variable=variable,
+    )
     return dataset_urls
 
 
 def get_subsetted_dataset(
-    subset_coords: tuple, dataset_urls: list
-) -> (list, list, list, list, list):
+    subset_coords: tuple,
+    dataset_urls: list,
+    valid_range: tuple | None = (0.001, 100.0),
+    log10: bool = False,
+    percentiles: tuple = (5, 25, 50, 75, 95),
+    cache_dir: str | None = CACHE_DIR,
+    max_workers: int = 1,
+    time_steps_per_chunk: int = 1,
+    throughput_log: str | None = THROUGHPUT_LOG,
+) -> (list, list, list, dict, list, list):
     """Subsets a dataset for the chosen geographical area, for multiple time-steps.
+    Each time-step is quality-controlled as it arrives (see process_chl), and its
+    statistics are returned so save_dataset can store them along with the data.
 
     Parameters
     -----------
@@ -126,6 +179,24 @@ def get_subsetted_dataset(
         coordinates for the subset in the format (lon_min, lon_max, lat_min, lat_max)
     dataset_urls : list
         list of urls for data access via opendap.
+    valid_range : tuple
+        (min, max) chl values. Values outside it are clipped to it. None skips it.
+    log10 : bool
+        if True, chl is log10-transformed.
+    percentiles : tuple
+        percentiles of the valid chl values to compute for each time-step.
+    cache_dir : str
+        directory where the subset of each file is cached, so it is only
+        downloaded once. Jobs on the same host that share it (by default, all of
+        them) also share their downloads (see fetch_subset). None disables the cache.
+    max_workers : int
+        number of files fetched at the same time, each in its own process.
+        1 fetches them one after the other.
+    time_steps_per_chunk : int
+        number of files handed to a worker process at once (if max_workers > 1).
+        plan_request proposes values for this and max_workers.
+    throughput_log : str
+        path of the log where download throughput is recorded. None disables it.
 
 
     Returns
@@ -133,11 +204,12 @@ def get_subsetted_dataset(
     lon : np.array
     lat : np.array
     chl : np.array
+    chl_stats : dict
+        per time-step "valid_count", "mean", "std" and "percentiles" of chl, along
+        with the "percentile_levels" and whether chl is "log10".
     time_start : list
     time_end : list
     """
-    # global subset_coords
-
     try:
         dataset = nc.Dataset(
             dataset_urls[0]
@@ -154,18 +226,7 @@ def get_subsetted_dataset(
     lon_original = dataset[lon_key][:]
     lat_original = dataset[lat_key][:]
 
-    ilon = [
-        find_nearest(lon_original, subset_coords[0])[0],
-        find_nearest(lon_original, subset_coords[1])[0],
-    ]
-    ilat = [
-        find_nearest(lat_original, subset_coords[2])[0],
-        find_nearest(lat_original, subset_coords[3])[0],
-    ]
-
-    # doing this b/c lat and/or lon may not monotonically decrease
-    ilon.sort()
-    ilat.sort()
+    ilon, ilat = get_subset_indices(lon_original, lat_original, subset_coords)
 
     # subsetting
     lon = lon_original[ilon[0] : ilon[1]]
@@ -176,39 +237,369 @@ def get_subsetted_dataset(
     # if var_dict[chl_key].dimensions[0] == 'lat':
     #     chl = dataset.variables[chl_key][ilat[0]:ilat[1], ilon[0]:ilon[1]]
 
-    # Accumulate times and subsetted chl values here, for all dataset_urls
+    # Accumulate times, subsetted chl values and their stats here, for all dataset_urls
     time_start = []
     time_end = []
-    for dataset_url in dataset_urls:
+    chl_steps = []
+    step_stats = []
+    fetch = functools.partial(
+        fetch_subset,
+        chl_key=chl_key,
+        ilat=ilat,
+        ilon=ilon,
+        cache_dir=cache_dir,
+        throughput_log=throughput_log,
+    )
+    with (
+        ProcessPoolExecutor(max_workers=max_workers)
+        if max_workers > 1
+        else contextlib.nullcontext()
+    ) as executor:
+        if executor is None:
+            subsets = map(fetch, dataset_urls)
+        else:
+            subsets = executor.map(fetch, dataset_urls, chunksize=time_steps_per_chunk)
+
+        # subsets come in the same order as dataset_urls
+        for k, (dataset_url, subset) in enumerate(zip(dataset_urls, subsets)):
+            print(
+                f" Gathering info from file {dataset_url.split('/')[-1]} "
+                f"- file {k + 1}/{len(dataset_urls)} "
+            )
+            if subset is None:
+                print(f"file {dataset_url.split('/')[-1]} is not reachable")
+                continue
+            _chl, _time_start, _time_end = subset
+
+            time_start.append(_time_start)
+            time_end.append(_time_end)
+            _chl, _stats = process_chl(
+                _chl, CHL_FILL_VALUE, valid_range, log10, percentiles
+            )
+            chl_steps.append(_chl)
+            step_stats.append(_stats)
+            del _chl
+    del ilon, ilat
+
+    if len(chl_steps) == 0:
+        print("## -- None of the files were reachable. Try again later. -- ##")
+        sys.exit()
+
+    # np.ma.stack keeps the masks (np.stack/np.concatenate would drop them)
+    chl = np.ma.stack(chl_steps)
+    del chl_steps
+
+    chl_stats = {
+        "valid_count": np.array([_stats["valid_count"] for _stats in step_stats]),
+        "mean": np.array([_stats["mean"] for _stats in step_stats]),
+        "std": np.array([_stats["std"] for _stats in step_stats]),
+        "percentiles": np.array([_stats["percentiles"] for _stats in step_stats]),
+        "percentile_levels": np.array(percentiles),
+        "log10": log10,
+    }
+
+    return lon, lat, chl, chl_stats, time_start, time_end
+
+
+def _download_subset(
+    dataset_url: str,
+    chl_key: str,
+    ilat: list,
+    ilon: list,
+    throughput_log: str | None = THROUGHPUT_LOG,
+):
+    """Downloads the subset of a single granule and records the throughput.
+
+    Returns
+    --------
+    subset : tuple
+        (chl, time_start, time_end), or None if the granule was not reachable.
+        Missing chl values are set to CHL_FILL_VALUE.
+    """
+    fetch_start = time.perf_counter()
+    try:
+        _dataset = nc.Dataset(dataset_url)
+    except OSError:
+        return None
+
+    # keeping as strings here b/c we can only save as str, int or float
+    time_start = _dataset.time_coverage_start
+    time_end = _dataset.time_coverage_end
+    chl = _dataset.variables[chl_key][ilat[0] : ilat[1], ilon[0] : ilon[1]]
+    chl = np.ma.filled(chl, CHL_FILL_VALUE)
+    _dataset.close()
+    record_throughput(chl.nbytes, time.perf_counter() - fetch_start, throughput_log)
+    return chl, time_start, time_end
+
+
+def _load_cached_subset(cache_path: str) -> tuple:
+    """Reads a (chl, time_start, time_end) subset from the subset cache."""
+    with np.load(cache_path) as cached:
+        return cached["chl"], str(cached["time_start"]), str(cached["time_end"])
+
+
+def fetch_subset(
+    dataset_url: str,
+    chl_key: str,
+    ilat: list,
+    ilon: list,
+    cache_dir: str | None = CACHE_DIR,
+    throughput_log: str | None = THROUGHPUT_LOG,
+):
+    """Gets the subset of a single granule, from the on-disk cache when possible.
+
+    With a cache_dir, concurrent jobs on the same host never download the same
+    granule window twice: the first one locks a file next to the cache entry and
+    downloads it, and the others wait on the lock and then read the entry from the
+    cache. If the downloading job fails or dies, the lock is released and a
+    waiting job downloads it instead. Only identical windows (same granule, ilat
+    and ilon) are shared: overlapping but different boxes are downloaded apart.
+    Entries are kept until clean_cache removes them.
+
+    Parameters
+    -----------
+    dataset_url : str
+        opendap url of the granule.
+    chl_key : str
+        name of the chlorophyll variable in the dataset.
+    ilat : list
+        [start, stop] lat indices of the subset.
+    ilon : list
+        [start, stop] lon indices of the subset.
+    cache_dir : str
+        directory of the subset cache, shared by the jobs on this host by default.
+        None downloads without coordination.
+    throughput_log : str
+        path of the log where download throughput is recorded. None disables it.
+
+    Returns
+    --------
+    subset : tuple
+        (chl, time_start, time_end), or None if the granule was not reachable.
+        Missing chl values are set to CHL_FILL_VALUE.
+    """
+    if not cache_dir:
+        return _download_subset(dataset_url, chl_key, ilat, ilon, throughput_log)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = get_cache_path(cache_dir, dataset_url, ilat, ilon)
+    try:
+        return _load_cached_subset(cache_path)
+    except FileNotFoundError:  # not cached yet, or just removed by clean_cache
+        pass
+
+    # waits here while another job is downloading the same subset
+    lock_fd = acquire_lock(f"{cache_path}.lock")
+    try:
+        if os.path.exists(cache_path):  # downloaded by the job we waited for
+            return _load_cached_subset(cache_path)
+
+        subset = _download_subset(dataset_url, chl_key, ilat, ilon, throughput_log)
+        if subset is not None:
+            # written aside and moved in place, so readers never see half a file
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, mode="wb") as f:
+                    np.savez(f, chl=subset[0], time_start=subset[1], time_end=subset[2])
+                os.replace(tmp_path, cache_path)
+            finally:  # not left behind if the write fails (e.g. disk full)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return subset
+    finally:
+        release_lock(lock_fd)
+
+
+def _read_windows(dataset_url: str, chl_key: str, windows: np.ndarray):
+    """Reads the chl values inside each window of a single granule.
+    Runs in a worker process (netCDF-C is not thread-safe).
+
+    Parameters
+    -----------
+    dataset_url : str
+        opendap url of the granule.
+    chl_key : str
+        name of the chlorophyll variable in the dataset.
+    windows : np.ndarray
+        (n_windows, 4) array of [lat_start, lat_stop, lon_start, lon_stop] indices.
+
+    Returns
+    --------
+    time_start : str
+    time_end : str
+    chl_windows : list
+        one float array per window, with NaN where there is no valid data and
+        outside of the grid. None if the granule was not reachable.
+    """
+    try:
+        _dataset = nc.Dataset(dataset_url)
+    except OSError:
+        return None
+
+    chl_var = _dataset.variables[chl_key]
+    n_lat, n_lon = chl_var.shape
+    chl_windows = []
+    for lat_start, lat_stop, lon_start, lon_stop in windows:
+        # only the part of the window inside the grid is read, the rest is NaN
+        _chl = chl_var[
+            max(lat_start, 0) : min(lat_stop, n_lat),
+            max(lon_start, 0) : min(lon_stop, n_lon),
+        ]
+        _chl = np.ma.filled(np.ma.asarray(_chl, dtype="f4"), np.nan)
+        chl_windows.append(
+            np.pad(
+                _chl,
+                (
+                    (max(-lat_start, 0), max(lat_stop - n_lat, 0)),
+                    (max(-lon_start, 0), max(lon_stop - n_lon, 0)),
+                ),
+                constant_values=np.nan,
+            )
+        )
+    time_start, time_end = _dataset.time_coverage_start, _dataset.time_coverage_end
+    _dataset.close()
+    return time_start, time_end, chl_windows
+
+
+def get_point_timeseries(
+    stations_lon,
+    stations_lat,
+    dataset_urls: list,
+    neighbourhood: int = 1,
+    block_size: int = 32,
+    max_workers: int = 4,
+    valid_range: tuple | None = (0.001, 100.0),
+    log10: bool = False,
+) -> (np.ndarray, np.ndarray, np.ndarray, dict, list, list):
+    """Extracts chl time series at station coordinates, without downloading the
+    whole box around them. Only small windows around groups of nearby stations
+    are read from each granule, and granules are fetched concurrently. The values
+    go through the same quality control as get_subsetted_dataset (see qc_chl).
+    The windows depend on the set of stations, so they are not stored in the
+    subset cache used by get_subsetted_dataset.
+
+    Parameters
+    -----------
+    stations_lon : np.array or list
+        longitude of each station.
+    stations_lat : np.array or list
+        latitude of each station.
+    dataset_urls : list
+        list of urls for data access via opendap.
+    neighbourhood : int
+        size N of the NxN box of pixels around each station used for the
+        neighbourhood statistics. Must be odd. 1 means the station pixel only.
+    block_size : int
+        size, in pixels, of the tiles used to group stations into read windows.
+    max_workers : int
+        number of granules fetched at the same time.
+    valid_range : tuple
+        (min, max) chl values. Values outside it are clipped to it. None skips it.
+    log10 : bool
+        if True, chl is log10-transformed (before the statistics are computed).
+
+    Returns
+    --------
+    lon : np.array
+        longitude of the grid pixel closest to each station.
+    lat : np.array
+        latitude of the grid pixel closest to each station.
+    chl : np.array
+        (station, time) chl values at the pixel closest to each station.
+    stats : dict
+        (station, time) arrays "mean", "std" and "valid_count", computed over the
+        NxN neighbourhood of each station.
+    time_start : list
+    time_end : list
+    """
+    if neighbourhood < 1 or neighbourhood % 2 == 0:
         print(
-            f" Gathering info from file {dataset_url.split('/')[-1]} "
-            f"- file {len(time_start) + 1}/{len(dataset_urls)} "
+            "Invalid 'neighbourhood' value. Must be an odd number. Terminating script."
         )
-        try:
-            _dataset = nc.Dataset(dataset_url)
-        except OSError:
-            print(f"file {dataset_url.split('/')[-1]} is not reachable")
-            continue
+        sys.exit()
+    half_width = neighbourhood // 2
 
-        time_start.append(
-            _dataset.time_coverage_start
-        )  # keeping as strings here b/c we can only save as str, int or float
-        time_end.append(_dataset.time_coverage_end)
-        _chl = _dataset.variables[chl_key][ilat[0] : ilat[1], ilon[0] : ilon[1]]
-        if dataset_url == dataset_urls[0]:
-            chl = _chl
-        else:
-            try:  # dataset_url == dataset_urls[1] (chl and _chl have the same shape)
-                chl = np.stack((chl, _chl))
-            except (
-                ValueError
-            ):  # (third or higher time-step / chl has one more dimension than _chl)
-                chl = np.concatenate((chl, [_chl]), axis=0)
-        _dataset.close()
-        del _chl, _dataset
-    del ilon, ilat
+    try:
+        dataset = nc.Dataset(dataset_urls[0])
+    except OSError:  # OSError: [Errno -70] NetCDF: DAP server error:
+        print("## -- DAP server error: not able to reach files. Try again later. -- ##")
+        sys.exit()
+
+    lon_key, lat_key, chl_key = get_dataset_keys(dataset_urls[0])
+    lon_original = dataset[lon_key][:]
+    lat_original = dataset[lat_key][:]
+    dataset.close()
 
-    return lon, lat, chl, time_start, time_end
+    # station coordinates -> grid indices, all stations at once
+    ilon = find_nearest_indices(lon_original, stations_lon)
+    ilat = find_nearest_indices(lat_original, stations_lat)
+    lon = np.asarray(lon_original[ilon])
+    lat = np.asarray(lat_original[ilat])
+    del lon_original, lat_original
+
+    windows, window_of_station = group_points(ilat, ilon, half_width, block_size)
+    print(
+        f" {len(ilat)} stations grouped in {len(windows)} read windows, "
+        f"for {len(dataset_urls)} files "
+    )
+
+    # position of each station's NxN neighbourhood inside its window
+    offsets = np.arange(-half_width, half_width + 1)
+    rows = (ilat - windows[window_of_station, 0])[:, None] + offsets
+    cols = (ilon - windows[window_of_station, 2])[:, None] + offsets
+    stations_in_window = [
+        np.flatnonzero(window_of_station == k) for k in range(len(windows))
+    ]
+
+    patches = []  # (station, N, N) for each time-step
+    time_start = []
+    time_end = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            _read_windows,
+            dataset_urls,
+            [chl_key] * len(dataset_urls),
+            [windows] * len(dataset_urls),
+        )
+        for dataset_url, result in zip(dataset_urls, results):
+            if result is None:
+                print(f"file {dataset_url.split('/')[-1]} is not reachable")
+                continue
+            _time_start, _time_end, chl_windows = result
+            time_start.append(_time_start)
+            time_end.append(_time_end)
+
+            _patches = np.empty((len(ilat), neighbourhood, neighbourhood), "f4")
+            for k, stations in enumerate(stations_in_window):
+                _patches[stations] = chl_windows[k][
+                    rows[stations][:, :, None], cols[stations][:, None, :]
+                ]
+            _patches = qc_chl(_patches, CHL_FILL_VALUE, valid_range, log10)
+            patches.append(np.ma.filled(_patches, np.nan))
+            print(
+                f" Gathered info from file {dataset_url.split('/')[-1]} "
+                f"- file {len(time_start)}/{len(dataset_urls)} "
+            )
+
+    if len(patches) == 0:
+        print("## -- None of the files were reachable. Try again later. -- ##")
+        sys.exit()
+
+    # (station, time, N*N)
+    patches = np.stack(patches, axis=1).reshape(len(ilat), len(time_start), -1)
+    chl = patches[:, :, (neighbourhood * neighbourhood) // 2]
+
+    valid = np.isfinite(patches)
+    valid_count = valid.sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, patches, 0).sum(axis=-1) / valid_count
+        std = np.sqrt(
+            np.where(valid, (patches - mean[..., None]) ** 2, 0).sum(axis=-1)
+            / valid_count
+        )
+    stats = {"mean": mean, "std": std, "valid_count": valid_count}
+
+    return lon, lat, chl, stats, time_start, time_end
 
 
 def save_dataset(
@@ -220,6 +611,8 @@ def save_dataset(
     space_res: str = "4km",
     time_res: str = "MO",
     subset_coords: tuple = (-70, -25, -15, 20),
+    datadir: str = "../../data",
+    chl_stats: dict | None = None,
 ) -> None:
     """Saves the dataset in a netcdf file.
 
@@ -236,21 +629,29 @@ def save_dataset(
         time resolution of the data. Must be either 'YR', 'MO', '8D', 'DAY'.
     subset_coords : tuple
         subset coordinates in the format (lonmin, lonmax, latmin, latmax).
+    datadir : str
+        directory where the file is saved.
+    chl_stats : dict
+        per time-step statistics, as returned by get_subsetted_dataset. They are
+        saved along with the data, and tell if chl is log10. None saves the data only.
     """
     # two options here: cftime and deal with it as string
 
     # get info for the filename of the dataset to be saved
     dataset = nc.Dataset(dataset_urls[0])
     lon_key, lat_key, chl_key = get_dataset_keys(dataset_urls[0])
-    yeari, monthi, dayi, yearf, monthf, dayf = get_dates(dataset_urls)
+    # granule table built by get_opendap_urls, already sorted by start date
+    date_first = granules["start"][0].astype("datetime64[M]")
+    date_last = granules["end"][-1].astype("datetime64[M]")
 
     filename = (
-        f"../../data/{source}_{variable}_{space_res}_{time_res}_"
-        f"{yeari[0]}{monthi[0]}_{yearf[-1]}{monthf[-1]}_"
+        f"{datadir}/{source}_{variable}_{space_res}_{time_res}_"
+        f"{str(date_first).replace('-', '')}_{str(date_last).replace('-', '')}_"
         f"{subset_coords[0]}_{subset_coords[1]}_"
         f"{subset_coords[2]}_{subset_coords[-1]}.nc"
     )
     print(f"## Filename under which the data will be saved: {filename} ##")
+    os.makedirs(datadir, exist_ok=True)
 
     ds = nc.Dataset(filename, "w", format="NETCDF4")
 
@@ -308,10 +709,14 @@ def save_dataset(
     ds.number_of_lines = chl.shape[-2]
     ds.number_of_columns = chl.shape[-1]
     ds._lastModified = date.today().strftime("%d %B %Y")
-    ds.data_minimum = chl.max()  # confirm this
-    ds.data_maximum = (
-        chl.min()
-    )  # confirm this - -32767.0 -> aprender a lidar com esse valor aqui
+    # fill values are masked, so they don't count as data here
+    chl = np.ma.masked_equal(np.ma.masked_invalid(chl), CHL_FILL_VALUE)
+    if chl.count():
+        ds.data_minimum = chl.min()
+        ds.data_maximum = chl.max()
+    else:  # no valid data at all (e.g. a fully cloudy box): min/max would be masked
+        ds.data_minimum = np.float32(np.nan)
+        ds.data_maximum = np.float32(np.nan)
 
     # -- creates dimensions -- ##
     #                            dimname, dimlength
@@ -336,7 +741,7 @@ def save_dataset(
             "lat",
             "lon",
         ),
-        fill_value=-32767.0,
+        fill_value=CHL_FILL_VALUE,
     )
 
     # -- assigns values to variables -- ##
@@ -368,5 +773,324 @@ def save_dataset(
     for attr in lon_attrs:
         ds.variables["lon"].setncattr(attr, getattr(dataset.variables[lon_key], attr))
 
+    if chl_stats is None:
+        ds.close()
+        print(f"## -- File {filename} saved! -- ##")
+        return
+
+    chl_units = getattr(ds.variables["chl"], "units", "mg m^-3")
+    if chl_stats["log10"]:
+        chl_units = f"log10({chl_units})"
+        ds.variables["chl"].units = chl_units
+        # the copied ranges are in mg m^-3: netCDF4 masks on read with valid_min/max,
+        # so left as they are they would hide every log10 value below them
+        for attr in ("valid_min", "valid_max", "display_min", "display_max"):
+            if attr not in ds.variables["chl"].ncattrs():
+                continue
+            value = ds.variables["chl"].getncattr(attr)
+            if value > 0:
+                ds.variables["chl"].setncattr(attr, np.float32(np.log10(value)))
+            else:
+                ds.variables["chl"].delncattr(attr)
+        # the CF standard name describes the concentration, not its log10
+        if "standard_name" in ds.variables["chl"].ncattrs():
+            ds.variables["chl"].delncattr("standard_name")
+        if getattr(ds.variables["chl"], "display_scale", None) == "log":
+            ds.variables["chl"].display_scale = "linear"
+
+    # -- per time-step stats, so the whole cube doesn't need to be read for them -- ##
+    _ = ds.createDimension("percentile", len(chl_stats["percentile_levels"]))
+    percentile_var = ds.createVariable("percentile", "f4", ("percentile",))
+    percentile_var[:] = chl_stats["percentile_levels"]
+
+    valid_count_var = ds.createVariable("chl_valid_count", "i4", ("time",))
+    valid_count_var.long_name = "number of valid chl pixels"
+    valid_count_var[:] = chl_stats["valid_count"]
+    for stat, long_name in (("mean", "mean"), ("std", "standard deviation")):
+        stat_var = ds.createVariable(
+            f"chl_{stat}", "f4", ("time",), fill_value=CHL_FILL_VALUE
+        )
+        stat_var.long_name = f"{long_name} of the valid chl pixels"
+        stat_var.units = chl_units
+        stat_var[:] = np.ma.masked_invalid(chl_stats[stat])
+    percentiles_var = ds.createVariable(
+        "chl_percentiles", "f4", ("time", "percentile"), fill_value=CHL_FILL_VALUE
+    )
+    percentiles_var.long_name = "percentiles of the valid chl pixels"
+    percentiles_var.units = chl_units
+    percentiles_var[:] = np.ma.masked_invalid(chl_stats["percentiles"])
+
     ds.close()
     print(f"## -- File {filename} saved! -- ##")
+
+
+# used to estimate times when no throughput was measured yet (bytes per second)
+DEFAULT_THROUGHPUT = 1e6
+
+
+def _nearest_existing_dir(path: str) -> str:
+    """Gets the directory itself if it exists, or else its nearest existing parent,
+    which is where it would be created."""
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def plan_request(
+    dataset_urls: list,
+    subset_coords: tuple = (-70, -25, -15, 20),
+    space_res: str = "4km",
+    datadir: str = "../../data",
+    cache_dir: str | None = CACHE_DIR,
+    chunk_bytes: int = 64 * 1024**2,
+    max_workers: int = 4,
+    throughput_log: str | None = THROUGHPUT_LOG,
+) -> dict:
+    """Estimates the cost of a request without fetching any data.
+
+    Parameters
+    -----------
+    dataset_urls : list
+        list of urls for data access via opendap, as returned by get_opendap_urls.
+    subset_coords : tuple
+        subset coordinates in the format (lonmin, lonmax, latmin, latmax).
+    space_res : str
+        space resolution of the data. Must be either '4km' or '9km'.
+    datadir : str
+        directory where the data will be saved (see save_dataset).
+    cache_dir : str
+        directory of the subset cache. None if the cache is not used.
+    chunk_bytes : int
+        maximum size, in bytes, of the files handed to a worker process at once.
+        Chunks are also kept small enough for every worker to get one.
+    max_workers : int
+        upper limit for the proposed number of concurrent fetches. The fetches wait
+        on the network rather than the CPU, so this limits the load on the server.
+    throughput_log : str
+        path of the log with the recent download throughput. None ignores it.
+
+    Returns
+    --------
+    plan : dict
+        granule counts, bytes to transfer, output size, expected time, free disk
+        space, and the proposed time_steps_per_chunk and max_workers for
+        get_subsetted_dataset.
+    """
+    check_space_res(space_res)
+    check_coords(subset_coords)
+
+    # the L3 mapped grid is fixed, so the windows are known without opening a file
+    lon, lat = get_grid(space_res)
+    ilon, ilat = get_subset_indices(lon, lat, subset_coords)
+    n_lines, n_columns = ilat[1] - ilat[0], ilon[1] - ilon[0]
+    bytes_per_granule = n_lines * n_columns * np.dtype("f4").itemsize
+
+    n_cached = 0
+    if cache_dir:
+        n_cached = sum(
+            os.path.exists(get_cache_path(cache_dir, dataset_url, ilat, ilon))
+            for dataset_url in dataset_urls
+        )
+    n_to_fetch = len(dataset_urls) - n_cached
+    bytes_to_transfer = n_to_fetch * bytes_per_granule
+    output_bytes = len(dataset_urls) * bytes_per_granule
+    cache_bytes = bytes_to_transfer if cache_dir else 0
+
+    # the output and the cache may be on different filesystems. Directories that
+    # don't exist yet are not created here: they'd be on their parent's filesystem
+    needed_bytes = {}
+    free_bytes = {}
+    for path, nbytes in ((datadir, output_bytes), (cache_dir, cache_bytes)):
+        if not path:
+            continue
+        path = _nearest_existing_dir(path)
+        device = os.stat(path).st_dev
+        needed_bytes[device] = needed_bytes.get(device, 0) + nbytes
+        free_bytes[device] = shutil.disk_usage(path).free
+
+    throughput = get_recent_throughput(throughput_log)
+    throughput_measured = throughput is not None
+    if not throughput_measured:
+        throughput = DEFAULT_THROUGHPUT
+    workers = int(max(1, min(max_workers, n_to_fetch)))
+    # at most an equal share of the files per worker, or some workers would sit idle
+    time_steps_per_chunk = int(
+        max(
+            1,
+            min(
+                math.ceil(n_to_fetch / workers),
+                chunk_bytes // max(bytes_per_granule, 1),
+            ),
+        )
+    )
+
+    return {
+        "n_granules": len(dataset_urls),
+        "n_cached": n_cached,
+        "n_to_fetch": n_to_fetch,
+        "window_shape": (n_lines, n_columns),
+        "bytes_per_granule": bytes_per_granule,
+        "bytes_to_transfer": bytes_to_transfer,
+        "output_bytes": output_bytes,
+        "cache_bytes": cache_bytes,
+        "output_free_bytes": shutil.disk_usage(_nearest_existing_dir(datadir)).free,
+        "cache_free_bytes": (
+            shutil.disk_usage(_nearest_existing_dir(cache_dir)).free
+            if cache_dir
+            else None
+        ),
+        "fits_on_disk": all(
+            needed_bytes[device] < free_bytes[device] for device in needed_bytes
+        ),
+        "throughput": throughput,
+        "throughput_measured": throughput_measured,
+        # throughput is measured per download, and downloads run side by side
+        "expected_seconds": bytes_to_transfer / (throughput * workers),
+        "time_steps_per_chunk": time_steps_per_chunk,
+        "max_workers": workers,
+    }
+
+
+def print_plan(plan: dict) -> None:
+    """Prints a request plan, as returned by plan_request.
+
+    Parameters
+    -----------
+    plan : dict
+    """
+    mb = 1024**2
+    throughput_source = "measured" if plan["throughput_measured"] else "default"
+    lines = [
+        "## -- Request plan (no data fetched) -- ##",
+        f" files: {plan['n_granules']} ({plan['n_cached']} cached, "
+        f"{plan['n_to_fetch']} to fetch)",
+        f" subset window: {plan['window_shape'][0]} x {plan['window_shape'][1]} "
+        f"pixels, {plan['bytes_per_granule'] / mb:.2f} MB per file",
+        f" to transfer: {plan['bytes_to_transfer'] / mb:.2f} MB",
+        f" output size: {plan['output_bytes'] / mb:.2f} MB "
+        f"(free: {plan['output_free_bytes'] / mb:.2f} MB)",
+    ]
+    if plan["cache_free_bytes"] is not None:
+        lines.append(
+            f" cache size: {plan['cache_bytes'] / mb:.2f} MB "
+            f"(free: {plan['cache_free_bytes'] / mb:.2f} MB)"
+        )
+    lines += [
+        f" expected time: {plan['expected_seconds'] / 60:.1f} min "
+        f"at {plan['throughput'] / mb:.2f} MB/s ({throughput_source} throughput)",
+        f" proposed settings: {plan['time_steps_per_chunk']} time-steps per chunk, "
+        f"{plan['max_workers']} concurrent fetches",
+    ]
+    print("\n".join(lines))
+    if not plan["fits_on_disk"]:
+        print("## -- Not enough disk space for this request! -- ##")
+
+
+def main() -> None:
+    """Command line entry point: fetches, subsets and saves the data,
+    or only prints the plan of the request with --dry-run."""
+    parser = argparse.ArgumentParser(
+        description="Gets subsetted chlorophyll-a data from MODIS via OPeNDAP."
+    )
+    parser.add_argument("--date-min", default="2021-11-01 00:00:00")
+    parser.add_argument("--date-max", default="2022-01-01 00:00:00")
+    parser.add_argument("--space-res", default="4km", choices=("4km", "9km"))
+    parser.add_argument("--time-res", default="MO", choices=("YR", "MO", "8D", "DAY"))
+    parser.add_argument(
+        "--subset-coords",
+        nargs=4,
+        type=float,
+        default=(-70, -25, -15, 20),
+        metavar=("LONMIN", "LONMAX", "LATMIN", "LATMAX"),
+    )
+    parser.add_argument("--datadir", default="../../data")
+    parser.add_argument(
+        "--cache-dir",
+        default=CACHE_DIR,
+        help="subset cache, shared with the other jobs that use the same directory",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache_dir",
+        action="store_const",
+        const=None,
+        help="don't cache the subsets, nor share downloads with other jobs",
+    )
+    parser.add_argument(
+        "--throughput-log",
+        default=THROUGHPUT_LOG,
+        help="where the download throughput is recorded and read from",
+    )
+    parser.add_argument(
+        "--no-throughput-log",
+        dest="throughput_log",
+        action="store_const",
+        const=None,
+        help="don't record or use the download throughput",
+    )
+    parser.add_argument(
+        "--clean-cache",
+        type=float,
+        default=None,
+        metavar="DAYS",
+        help="first remove the cache entries older than DAYS days",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print the plan and cost of the request, without fetching data",
+    )
+    args = parser.parse_args()
+    subset_coords = tuple(args.subset_coords)
+
+    if args.clean_cache is not None and not args.dry_run:
+        n_removed = clean_cache(args.cache_dir, args.clean_cache)
+        print(f"## -- {n_removed} old subsets removed from the cache -- ##")
+
+    dataset_urls = get_opendap_urls(
+        args.date_min,
+        args.date_max,
+        args.space_res,
+        args.time_res,
+        subset_coords,
+        datadir=args.datadir,
+    )
+    plan = plan_request(
+        dataset_urls,
+        subset_coords,
+        args.space_res,
+        datadir=args.datadir,
+        cache_dir=args.cache_dir,
+        throughput_log=args.throughput_log,
+    )
+    print_plan(plan)
+    if args.dry_run:
+        return
+    if not plan["fits_on_disk"]:
+        sys.exit()
+
+    lon, lat, chl, chl_stats, time_start, time_end = get_subsetted_dataset(
+        subset_coords,
+        dataset_urls,
+        cache_dir=args.cache_dir,
+        max_workers=plan["max_workers"],
+        time_steps_per_chunk=plan["time_steps_per_chunk"],
+        throughput_log=args.throughput_log,
+    )
+    save_dataset(
+        lon,
+        lat,
+        chl,
+        time_start,
+        time_end,
+        space_res=args.space_res,
+        time_res=args.time_res,
+        subset_coords=subset_coords,
+        datadir=args.datadir,
+        chl_stats=chl_stats,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 from __future__ import annotations
 
 import functools
+import json
+import os
 import re
 import sys
+import time
 from datetime import datetime
 
 import netCDF4 as nc
 import numpy as np
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
 
 def debug(func):
     """Print the function signature and return value"""
@@ -120,6 +128,453 @@ def find_nearest(array, target_value: int | float) -> (int, float):
     return idx, array[idx]
 
 
+def find_nearest_indices(array, target_values) -> np.ndarray:
+    """Finds, for many target values at once, the index of the closest array element.
+    Vectorized counterpart of find_nearest, for monotonic coordinate arrays.
+
+    Parameters:
+    -----------
+    array : np.array or list
+        monotonic (increasing or decreasing) coordinates, e.g. lat or lon.
+    target_values : np.array or list
+
+    Returns:
+    --------
+    idx : np.array
+        indices of the array elements closest to each target value.
+    """
+    array = np.asarray(array)
+    target_values = np.asarray(target_values)
+
+    # lat usually decreases in the L3 grids; searchsorted needs increasing values
+    descending = array[0] > array[-1]
+    ordered = array[::-1] if descending else array
+
+    idx = np.searchsorted(ordered, target_values).clip(1, len(ordered) - 1)
+    closer_to_left = (target_values - ordered[idx - 1]) <= (
+        ordered[idx] - target_values
+    )
+    idx = idx - closer_to_left
+    if descending:
+        idx = len(array) - 1 - idx
+    return idx
+
+
+def group_points(
+    ilat: np.ndarray,
+    ilon: np.ndarray,
+    half_width: int = 0,
+    block_size: int = 32,
+) -> (np.ndarray, np.ndarray):
+    """Groups grid points that are close to each other into small read windows.
+    Points falling in the same block_size x block_size tile of the grid share one
+    window, so the data read grows with the number of points, not with the area.
+
+    Parameters
+    -----------
+    ilat : np.ndarray
+        lat index of each point in the grid.
+    ilon : np.ndarray
+        lon index of each point in the grid.
+    half_width : int
+        number of pixels needed around each point (e.g. 1 for a 3x3 neighbourhood).
+    block_size : int
+        size, in pixels, of the tiles used to group the points.
+
+    Returns
+    --------
+    windows : np.ndarray
+        (n_windows, 4) array of [lat_start, lat_stop, lon_start, lon_stop] indices.
+        Windows may extend beyond the grid edges by up to half_width pixels.
+    window_of_point : np.ndarray
+        index of the window each point belongs to.
+    """
+    ilat = np.asarray(ilat)
+    ilon = np.asarray(ilon)
+
+    tiles = np.stack((ilat // block_size, ilon // block_size), axis=1)
+    _, window_of_point = np.unique(tiles, axis=0, return_inverse=True)
+    window_of_point = window_of_point.ravel()
+    n_windows = window_of_point.max() + 1 if len(window_of_point) else 0
+
+    windows = np.empty((n_windows, 4), dtype=np.int64)
+    windows[:, [0, 2]] = np.iinfo(np.int64).max
+    windows[:, [1, 3]] = np.iinfo(np.int64).min
+    np.minimum.at(windows[:, 0], window_of_point, ilat - half_width)
+    np.maximum.at(windows[:, 1], window_of_point, ilat + half_width + 1)
+    np.minimum.at(windows[:, 2], window_of_point, ilon - half_width)
+    np.maximum.at(windows[:, 3], window_of_point, ilon + half_width + 1)
+    return windows, window_of_point
+
+
+# fill value of chlor_a in the L3 mapped files
+CHL_FILL_VALUE = -32767.0
+
+
+def qc_chl(
+    chl,
+    fill_value: float = CHL_FILL_VALUE,
+    valid_range: tuple | None = (0.001, 100.0),
+    log10: bool = False,
+) -> np.ma.MaskedArray:
+    """Masks missing chl values, clips the rest to the valid range and optionally
+    log10-transforms them.
+
+    Parameters
+    -----------
+    chl : np.array
+        chl values, of any shape. NaN is also taken as missing.
+    fill_value : float
+        value used for missing data, which is masked out.
+    valid_range : tuple
+        (min, max) chl values. Values outside it are clipped to it. None skips it.
+    log10 : bool
+        if True, returns log10(chl).
+
+    Returns
+    --------
+    chl : np.ma.MaskedArray
+        quality-controlled chl, with missing data masked.
+    """
+    chl = np.ma.masked_invalid(np.ma.asarray(chl, dtype="f4"))
+    chl = np.ma.masked_equal(chl, fill_value)
+    if valid_range is not None:
+        chl = np.ma.clip(chl, *valid_range)
+    if log10:
+        chl = np.ma.log10(chl)  # non-positive values get masked
+    return chl
+
+
+def process_chl(
+    chl,
+    fill_value: float = CHL_FILL_VALUE,
+    valid_range: tuple | None = (0.001, 100.0),
+    log10: bool = False,
+    percentiles: tuple = (5, 25, 50, 75, 95),
+) -> (np.ma.MaskedArray, dict):
+    """Quality-controls one time-step of chl (see qc_chl) and computes its
+    summary statistics.
+
+    Parameters
+    -----------
+    chl : np.array
+        chl values of a single time-step (lat, lon).
+    fill_value : float
+        value used for missing data, which is masked out.
+    valid_range : tuple
+        (min, max) chl values. Values outside it are clipped to it. None skips it.
+    log10 : bool
+        if True, returns log10(chl).
+    percentiles : tuple
+        percentiles of the valid values to compute, between 0 and 100.
+
+    Returns
+    --------
+    chl : np.ma.MaskedArray
+        processed chl, with missing data masked.
+    stats : dict
+        "valid_count", "mean", "std" and "percentiles" of the valid values
+        (after the log10 transform, if applied).
+    """
+    chl = qc_chl(chl, fill_value, valid_range, log10)
+
+    values = chl.compressed()
+    if values.size:
+        stats = {
+            "valid_count": values.size,
+            "mean": values.mean(),
+            "std": values.std(),
+            "percentiles": np.percentile(values, percentiles),
+        }
+    else:
+        stats = {
+            "valid_count": 0,
+            "mean": np.nan,
+            "std": np.nan,
+            "percentiles": np.full(len(percentiles), np.nan),
+        }
+    return chl, stats
+
+
+# (lines, columns) of the global L3 mapped grids
+L3M_GRID_SHAPE = {"4km": (4320, 8640), "9km": (2160, 4320)}
+
+# recent measured download throughput, used to estimate how long a request takes.
+# Can be moved with the MODISDATAFETCHER_THROUGHPUT_LOG environment variable, and
+# every function that uses it takes a log path where None disables it.
+THROUGHPUT_LOG = os.environ.get(
+    "MODISDATAFETCHER_THROUGHPUT_LOG",
+    os.path.join(os.path.expanduser("~"), ".modisdatafetcher", "throughput.json"),
+)
+
+# subset cache shared by the jobs running on this host, so they don't download the
+# same subsets (see fetch_subset). Can be moved with the MODISDATAFETCHER_CACHE_DIR
+# environment variable, and every function that uses it takes a cache_dir where
+# None disables the cache.
+CACHE_DIR = os.environ.get(
+    "MODISDATAFETCHER_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".modisdatafetcher", "cache"),
+)
+
+
+def get_grid(space_res: str = "4km") -> (np.ndarray, np.ndarray):
+    """Builds the lon and lat of the global L3 mapped grid, without fetching it.
+
+    Parameters
+    -----------
+    space_res : str
+        space resolution of the data. Must be either '4km' or '9km'.
+
+    Returns
+    --------
+    lon : np.array
+        pixel-centre longitudes, increasing from -180.
+    lat : np.array
+        pixel-centre latitudes, decreasing from 90.
+    """
+    n_lines, n_columns = L3M_GRID_SHAPE[space_res]
+    step = 180 / n_lines
+    lon = (-180 + step * (np.arange(n_columns) + 0.5)).astype("f4")
+    lat = (90 - step * (np.arange(n_lines) + 0.5)).astype("f4")
+    return lon, lat
+
+
+def get_subset_indices(lon, lat, subset_coords: tuple) -> (list, list):
+    """Finds the grid index windows that correspond to the subset coordinates.
+
+    Parameters
+    -----------
+    lon : np.array
+    lat : np.array
+    subset_coords : tuple
+        subset coordinates in the format (lonmin, lonmax, latmin, latmax).
+
+    Returns
+    --------
+    ilon : list
+        [start, stop] lon indices of the subset.
+    ilat : list
+        [start, stop] lat indices of the subset.
+    """
+    ilon = [
+        find_nearest(lon, subset_coords[0])[0],
+        find_nearest(lon, subset_coords[1])[0],
+    ]
+    ilat = [
+        find_nearest(lat, subset_coords[2])[0],
+        find_nearest(lat, subset_coords[3])[0],
+    ]
+
+    # doing this b/c lat and/or lon may not monotonically decrease
+    ilon.sort()
+    ilat.sort()
+    return ilon, ilat
+
+
+def get_cache_path(cache_dir: str, dataset_url: str, ilat: list, ilon: list) -> str:
+    """Builds the path under which a subset of a granule is cached.
+
+    Parameters
+    -----------
+    cache_dir : str
+        directory of the subset cache.
+    dataset_url : str
+        opendap url of the granule.
+    ilat : list
+        [start, stop] lat indices of the subset.
+    ilon : list
+        [start, stop] lon indices of the subset.
+
+    Returns
+    --------
+    cache_path : str
+    """
+    granule = dataset_url.split("/")[-1].replace(".nc", "")
+    return os.path.join(
+        cache_dir, f"{granule}_{ilat[0]}_{ilat[1]}_{ilon[0]}_{ilon[1]}.npz"
+    )
+
+
+def acquire_lock(lock_path: str, blocking: bool = True) -> int | None:
+    """Takes an exclusive lock on a lock file, so only one process on this host
+    does a given job at a time. The lock is held by the kernel (flock), so it is
+    released when the process ends, even if it crashes, and can't be taken over
+    while its owner is alive.
+
+    Parameters
+    -----------
+    lock_path : str
+        path of the lock file. It is created if needed, and only removed by the
+        process holding the lock (see clean_cache): whoever was waiting on the
+        removed file then locks the new one instead.
+    blocking : bool
+        if True, waits until the lock is free. If False, gives up right away.
+
+    Returns
+    --------
+    lock_fd : int
+        file descriptor holding the lock, to be passed to release_lock.
+        None if blocking is False and the lock is held by another process.
+    """
+    while True:
+        lock_fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+        if fcntl is None:  # no flock (e.g. Windows): no coordination between processes
+            return lock_fd
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(lock_fd)
+            return None
+        # the lock only counts if the locked file is still the one at lock_path,
+        # as it may have been removed while waiting for it
+        try:
+            if os.path.samestat(os.fstat(lock_fd), os.stat(lock_path)):
+                return lock_fd
+        except FileNotFoundError:
+            pass
+        release_lock(lock_fd)
+
+
+def release_lock(lock_fd: int) -> None:
+    """Releases a lock taken with acquire_lock.
+
+    Parameters
+    -----------
+    lock_fd : int
+        file descriptor returned by acquire_lock.
+    """
+    if fcntl is not None:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    os.close(lock_fd)
+
+
+def _remove_if_exists(path: str) -> bool:
+    """Removes a file, if it is still there. Returns True if it was removed."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def clean_cache(cache_dir: str | None = CACHE_DIR, max_age_days: float = 30) -> int:
+    """Removes the subset cache entries written more than max_age_days ago, along
+    with their lock files, and what failed or interrupted fetches left behind.
+    Entries being fetched at the moment are left alone, so it can run while other
+    jobs use the cache (e.g. from a daily cron job).
+
+    Parameters
+    -----------
+    cache_dir : str
+        directory of the subset cache (see fetch_subset). None does nothing.
+    max_age_days : float
+        entries older than this, in days, are removed. 0 empties the cache.
+
+    Returns
+    --------
+    n_removed : int
+        number of cache entries removed.
+    """
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return 0
+    oldest = time.time() - max_age_days * 24 * 3600
+
+    # entry.npz, entry.npz.lock and entry.npz.<pid>.tmp all belong to entry.npz
+    tmp_paths = {}
+    for name in os.listdir(cache_dir):
+        if ".npz" not in name:
+            continue
+        cache_path = os.path.join(cache_dir, name.split(".npz")[0] + ".npz")
+        tmp_paths.setdefault(cache_path, [])
+        if name.endswith(".tmp"):
+            tmp_paths[cache_path].append(os.path.join(cache_dir, name))
+
+    n_removed = 0
+    for cache_path in sorted(tmp_paths):
+        try:
+            if os.path.getmtime(cache_path) >= oldest:
+                continue
+        except FileNotFoundError:  # only leftovers of failed fetches
+            pass
+
+        lock_fd = acquire_lock(f"{cache_path}.lock", blocking=False)
+        if lock_fd is None:  # being fetched right now
+            continue
+        try:
+            n_removed += _remove_if_exists(cache_path)
+            for tmp_path in tmp_paths[cache_path]:
+                _remove_if_exists(tmp_path)
+            _remove_if_exists(f"{cache_path}.lock")
+        finally:
+            release_lock(lock_fd)
+    return n_removed
+
+
+def _load_throughput_records(log_path: str) -> list:
+    """Reads the [bytes, seconds] measurements of the throughput log."""
+    try:
+        with open(log_path, mode="r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+
+def record_throughput(
+    nbytes: int, seconds: float, log_path: str | None = THROUGHPUT_LOG, keep: int = 100
+) -> None:
+    """Appends a download measurement to the throughput log, keeping the latest ones.
+
+    Parameters
+    -----------
+    nbytes : int
+        number of bytes downloaded.
+    seconds : float
+        time the download took.
+    log_path : str
+        path of the throughput log. None disables the log.
+    keep : int
+        number of measurements kept in the log.
+    """
+    if log_path is None:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+
+    # several jobs (or workers) may be recording at once: the lock keeps their
+    # updates from overwriting each other, the move keeps readers off half-written logs
+    lock_fd = acquire_lock(f"{log_path}.lock")
+    try:
+        records = _load_throughput_records(log_path)
+        records = (records + [[int(nbytes), float(seconds)]])[-keep:]
+
+        tmp_path = f"{log_path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w") as f:
+            json.dump(records, f)
+        os.replace(tmp_path, log_path)
+    finally:
+        release_lock(lock_fd)
+
+
+def get_recent_throughput(log_path: str | None = THROUGHPUT_LOG) -> float | None:
+    """Gets the download throughput measured in recent requests.
+
+    Parameters
+    -----------
+    log_path : str
+        path of the throughput log. None disables the log.
+
+    Returns
+    --------
+    throughput : float
+        bytes per second, or None if nothing was measured yet.
+    """
+    if log_path is None:
+        return None
+    records = np.array(_load_throughput_records(log_path), dtype=float).reshape(-1, 2)
+    if records[:, 1].sum() <= 0:
+        return None
+    return records[:, 0].sum() / records[:, 1].sum()
+
+
 def get_filelist_command(
     date_min: str,
     date_max: str,
@@ -161,8 +616,169 @@ def get_filelist_command(
     return curl_command
 
 
+# one row per granule: parsed start/end dates and the period (time_res) of the file
+GRANULE_DTYPE = np.dtype(
+    [("start", "datetime64[D]"), ("end", "datetime64[D]"), ("period", "U3")]
+)
+
+
+def _yyyymmdd_to_datetime64(dates: np.ndarray) -> np.ndarray:
+    """Converts an array of 'YYYYMMDD' strings to datetime64[D], in one go."""
+    dates = dates.astype(np.int64)
+    years = (dates // 10000 - 1970).astype("datetime64[Y]")
+    months = (dates // 100 % 100 - 1).astype("timedelta64[M]")
+    days = (dates % 100 - 1).astype("timedelta64[D]")
+    return (years.astype("datetime64[M]") + months).astype("datetime64[D]") + days
+
+
+def _split_dates(dates: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    """Splits datetime64[D] values into zero-padded year, month and day strings."""
+    months = dates.astype("datetime64[M]")
+    years = months.astype("datetime64[Y]").astype(np.int64) + 1970
+    month_numbers = months.astype(np.int64) % 12 + 1
+    days = (dates - months).astype(np.int64) + 1
+    return (
+        np.char.zfill(years.astype("U4"), 4),
+        np.char.zfill(month_numbers.astype("U2"), 2),
+        np.char.zfill(days.astype("U2"), 2),
+    )
+
+
+def get_granule_table(filenames: list) -> np.ndarray:
+    """Parses all filenames (or opendap urls) at once into a granule table.
+
+    Parameters
+    -----------
+    filenames : list
+        filenames or urls such as 'AQUA_MODIS.20211101_20211130.L3m.MO.(...).nc',
+        or 'AQUA_MODIS.20211101.L3m.DAY.(...).nc' for daily files (single date).
+
+    Returns
+    --------
+    granules : np.ndarray
+        structured array with GRANULE_DTYPE ('start', 'end', 'period'),
+        one row per filename, in the same order as the input. For daily files,
+        end is the same as start.
+
+    Raises
+    ------
+    ValueError
+        if any of the filenames doesn't follow the L3 mapped naming pattern.
+    """
+    # a single regex pass over all the names instead of one per filename
+    granule_regex = re.compile(
+        r"^[^\n]*?([0-9]{8})(?:_([0-9]{8}))?\.L3m\.([0-9A-Z]+)\.[^\n]*$", re.MULTILINE
+    )
+    matches = granule_regex.findall("\n".join(filenames))
+
+    if len(matches) != len(filenames):
+        unmatched = [
+            filename for filename in filenames if not granule_regex.match(filename)
+        ]
+        raise ValueError(f"Filenames with unexpected format: {unmatched}")
+
+    granules = np.empty(len(matches), dtype=GRANULE_DTYPE)
+    if len(matches) == 0:
+        return granules
+
+    starts, ends, periods = np.array(matches).T
+    ends = np.where(ends == "", starts, ends)  # daily files have a single date
+    granules["start"] = _yyyymmdd_to_datetime64(starts)
+    granules["end"] = _yyyymmdd_to_datetime64(ends)
+    granules["period"] = periods
+    return granules
+
+
+def filter_granules(
+    granules: np.ndarray,
+    date_min: str | None = None,
+    date_max: str | None = None,
+) -> np.ndarray:
+    """Keeps the granules within the requested time range, sorted and de-duplicated.
+
+    Parameters
+    -----------
+    granules : np.ndarray
+        granule table, as returned by get_granule_table.
+    date_min : str
+        start date, in the format "%Y-%m-%d %H:%M:%S". Granules ending before
+        it are dropped.
+    date_max : str
+        end date, in the format "%Y-%m-%d %H:%M:%S". Granules starting after
+        it are dropped.
+
+    Returns
+    --------
+    granules : np.ndarray
+        filtered granule table, sorted by start date, without repeated rows.
+    """
+    keep = np.ones(len(granules), dtype=bool)
+    if date_min is not None:
+        keep &= granules["end"] >= np.datetime64(date_min[:10], "D")
+    if date_max is not None:
+        keep &= granules["start"] <= np.datetime64(date_max[:10], "D")
+
+    # np.unique sorts by the fields in order (start, end, period)
+    return np.unique(granules[keep])
+
+
+def build_opendap_urls(
+    granules: np.ndarray,
+    space_res: str = "4km",
+    opendap_base_url: str = "http://oceandata.sci.gsfc.nasa.gov/opendap/MODISA/",
+    level: str = "L3",
+    map_bin: str = "m",
+    source: str = "AQUA_MODIS",
+    variable: str = "CHL",
+) -> list:
+    """Builds the opendap urls for all granules of a granule table at once.
+
+    Parameters
+    -----------
+    granules : np.ndarray
+        granule table, as returned by get_granule_table.
+    space_res : str
+        spatial resolution of the data. Must be either '4km' or '9km'.
+
+    Returns
+    --------
+    dataset_urls : list
+        list of urls for data access via opendap.
+    """
+    if len(granules) == 0:
+        return []
+
+    yeari, monthi, dayi = _split_dates(granules["start"])
+    yearf, monthf, dayf = _split_dates(granules["end"])
+    starts = np.char.add(np.char.add(yeari, monthi), dayi)
+    ends = np.char.add(np.char.add(yearf, monthf), dayf)
+
+    # daily files are named after a single date, the others after start_end
+    dates = np.where(
+        granules["period"] == "DAY", starts, np.char.add(np.char.add(starts, "_"), ends)
+    )
+
+    urls = np.full(len(granules), f"{opendap_base_url}{level}SMI/")
+    for part in (
+        yeari,
+        "/",
+        monthi,
+        dayi,
+        f"/{source}.",
+        dates,
+        f".{level}{map_bin}.",
+        granules["period"],
+        f".{variable}.chlor_a.{space_res}.nc",
+    ):
+        urls = np.char.add(urls, part)
+    return urls.tolist()
+
+
 def get_dates(filenames: list) -> (list, list, list, list, list, list):
     """Gets dates from each filename in order to build the opendap urls.
+    Kept for backwards compatibility; get_granule_table is the bulk version.
+    Filenames must follow the L3 mapped naming pattern (see get_granule_table),
+    otherwise a ValueError is raised, so the output always has one row per input.
 
     Parameters
     -----------
@@ -186,19 +802,20 @@ def get_dates(filenames: list) -> (list, list, list, list, list, list):
 
     """
 
-    dates_regex = re.compile("[0-9]{8}")
-
-    yeari, yearf = [], []
-    monthi, monthf = [], []
-    dayi, dayf = [], []
-    for filename in filenames:
-        dates = re.findall(dates_regex, filename)
-        yeari.append(dates[0][0:4]), yearf.append(dates[1][0:4])
-        monthi.append(dates[0][4:6]), monthf.append(dates[1][4:6])
-        dayi.append(dates[0][6:]), dayf.append(dates[1][6:])
-        del dates
-    del dates_regex
-    return yeari, monthi, dayi, yearf, monthf, dayf
+    granules = get_granule_table(filenames)
+    if len(granules) == 0:
+        return [], [], [], [], [], []
+
+    yeari, monthi, dayi = _split_dates(granules["start"])
+    yearf, monthf, dayf = _split_dates(granules["end"])
+    return (
+        yeari.tolist(),
+        monthi.tolist(),
+        dayi.tolist(),
+        yearf.tolist(),
+        monthf.tolist(),
+        dayf.tolist(),
+    )
 
 
 def get_dataset_keys(dataset_path: str) -> (str, str, str):
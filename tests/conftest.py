@@ -0,0 +1,8 @@
+import os
+import sys
+
+# modisdatafetcher.py imports its helpers with "from utilities import (...)",
+# so its own folder needs to be importable when running the tests from the root
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), os.pardir, "src", "modisdatafetcher")
+)
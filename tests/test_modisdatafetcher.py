@@ -1,10 +1,24 @@
 # pytest test_get_chl3.py -v --durations=0
 
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import netCDF4 as nc
+import numpy as np
 import pytest
+import src.modisdatafetcher.modisdatafetcher as modisdatafetcher
 from src.modisdatafetcher.modisdatafetcher import (
     get_opendap_urls,
     get_subsetted_dataset,
+    get_point_timeseries,
+    plan_request,
+    save_dataset,
+    fetch_subset,
 )
+from src.modisdatafetcher.utilities import get_granule_table
 
 
 @pytest.fixture
@@ -28,6 +42,61 @@ def settings_dict():
     }
 
 
+# small local granules (1-degree grid), so the data handling can be tested offline
+@pytest.fixture
+def local_dataset_urls(tmp_path):
+    dataset_urls = []
+    for month, seed in (("11", 0.0), ("12", 1.0)):
+        path = str(
+            tmp_path
+            / f"AQUA_MODIS.2021{month}01_2021{month}28.L3m.MO.CHL.chlor_a.4km.nc"
+        )
+        ds = nc.Dataset(path, "w")
+        ds.title = "local granule"
+        for attr in (
+            "date_created",
+            "start_orbit_number",
+            "northernmost_latitude",
+            "southernmost_latitude",
+            "westernmost_longitude",
+            "easternmost_longitude",
+            "geospatial_lat_max",
+            "geospatial_lat_min",
+            "geospatial_lon_max",
+            "geospatial_lon_min",
+            "sw_point_latitude",
+            "sw_point_longitude",
+            "number_of_lines",
+            "number_of_columns",
+            "_lastModified",
+            "data_minimum",
+            "data_maximum",
+        ):
+            ds.setncattr(attr, "-")
+        ds.time_coverage_start = f"2021-{month}-01T00:00:00.000Z"
+        ds.time_coverage_end = f"2021-{month}-28T23:59:59.000Z"
+        ds.createDimension("lat", 180)
+        ds.createDimension("lon", 360)
+        lat = ds.createVariable("lat", "f4", ("lat",), fill_value=-999.0)
+        lat[:] = np.linspace(89.5, -89.5, 180)
+        lon = ds.createVariable("lon", "f4", ("lon",), fill_value=-999.0)
+        lon[:] = np.linspace(-179.5, 179.5, 360)
+        chl = ds.createVariable("chlor_a", "f4", ("lat", "lon"), fill_value=-32767.0)
+        chl.units = "mg m^-3"
+        chl.standard_name = "mass_concentration_of_chlorophyll_in_sea_water"
+        chl.valid_min = np.float32(0.001)
+        chl.valid_max = np.float32(100.0)
+        chl.display_min = np.float32(0.01)
+        chl.display_max = np.float32(20.0)
+        values = np.full((180, 360), 0.1 + seed, dtype="f4")
+        values[0, :] = -32767.0  # missing data along the northernmost line
+        values[90, 180] = 500.0  # above the valid range
+        chl[:] = values
+        ds.close()
+        dataset_urls.append(path)
+    return dataset_urls
+
+
 def test_get_opendap_urls(settings_dict, tmpdir):
     dataset_urls = get_opendap_urls(
         settings_dict["date_min"],
@@ -41,8 +110,259 @@ def test_get_opendap_urls(settings_dict, tmpdir):
 
 
 def test_get_subsetted_dataset(settings_dict):
-    lon, lat, chl, time_start, time_end = get_subsetted_dataset(
+    lon, lat, chl, chl_stats, time_start, time_end = get_subsetted_dataset(
         subset_coords=settings_dict["subset_coords"],
         dataset_urls=settings_dict["dataset_urls"],
+        cache_dir=None,
+        throughput_log=None,
     )
     assert len(lon)
+
+
+def test_get_point_timeseries(settings_dict):
+    lon, lat, chl, stats, time_start, time_end = get_point_timeseries(
+        stations_lon=[-69.5, -68.5],
+        stations_lat=[-14.5, -13.5],
+        dataset_urls=settings_dict["dataset_urls"],
+        neighbourhood=3,
+    )
+    assert chl.shape == (2, 1)
+    assert stats["valid_count"].max() <= 9
+
+
+def test_plan_request(settings_dict, tmpdir):
+    plan = plan_request(
+        settings_dict["dataset_urls"],
+        settings_dict["subset_coords"],
+        settings_dict["space_res"],
+        datadir=tmpdir,
+        cache_dir=tmpdir,
+        throughput_log=None,
+    )
+    assert (plan["n_granules"], plan["n_cached"], plan["n_to_fetch"]) == (1, 0, 1)
+    assert plan["bytes_to_transfer"] == 48 * 48 * 4
+    assert (plan["max_workers"], plan["time_steps_per_chunk"]) == (1, 1)
+    assert plan["fits_on_disk"]
+
+
+def test_plan_request_creates_no_directories(settings_dict, tmp_path):
+    datadir = tmp_path / "data" / "MO"
+    cache_dir = tmp_path / "cache"
+    plan = plan_request(
+        settings_dict["dataset_urls"],
+        settings_dict["subset_coords"],
+        settings_dict["space_res"],
+        datadir=str(datadir),
+        cache_dir=str(cache_dir),
+        throughput_log=None,
+    )
+    assert not datadir.parent.exists() and not cache_dir.exists()
+    assert plan["n_cached"] == 0
+    assert plan["output_free_bytes"] == plan["cache_free_bytes"] > 0
+    assert plan["fits_on_disk"]
+
+
+def _slow_getpid(_):
+    time.sleep(0.2)
+    return os.getpid()
+
+
+def test_plan_request_uses_every_worker(settings_dict, tmpdir):
+    # 12 monthly files of a small box: all of them would fit in a single chunk
+    dataset_urls = [
+        settings_dict["dataset_path"].replace("20211101_", f"2021{month:02d}01_")
+        for month in range(1, 13)
+    ]
+    plan = plan_request(
+        dataset_urls,
+        settings_dict["subset_coords"],
+        settings_dict["space_res"],
+        datadir=tmpdir,
+        cache_dir=None,
+        throughput_log=None,
+    )
+    assert (plan["max_workers"], plan["time_steps_per_chunk"]) == (4, 3)
+
+    # the proposed settings, as get_subsetted_dataset uses them
+    with ProcessPoolExecutor(max_workers=plan["max_workers"]) as executor:
+        pids = executor.map(
+            _slow_getpid, dataset_urls, chunksize=plan["time_steps_per_chunk"]
+        )
+        assert len(set(pids)) == plan["max_workers"]
+
+
+def test_get_point_timeseries_local(local_dataset_urls):
+    lon, lat, chl, stats, time_start, time_end = get_point_timeseries(
+        stations_lon=[0.5, -179.5, 10.5],
+        stations_lat=[-0.5, 89.5, 10.5],
+        dataset_urls=local_dataset_urls,
+        neighbourhood=3,
+        max_workers=2,
+        valid_range=(0.001, 1.0),
+    )
+    assert chl.shape == (3, 2)
+    assert np.isnan(chl[0]).all()  # outside the file's valid_min/valid_max
+    assert np.isnan(chl[1]).all()  # fill value masked
+    assert np.allclose(chl[2], [0.1, 1.0])  # clipped to the valid range
+    assert stats["valid_count"].tolist() == [[8, 8], [2, 2], [9, 9]]
+    assert time_start == ["2021-11-01T00:00:00.000Z", "2021-12-01T00:00:00.000Z"]
+
+
+# save_dataset uses what get_opendap_urls keeps for it
+@pytest.fixture
+def local_opendap_urls(local_dataset_urls, monkeypatch):
+    monkeypatch.setattr(modisdatafetcher, "dataset_urls", local_dataset_urls, False)
+    monkeypatch.setattr(
+        modisdatafetcher, "granules", get_granule_table(local_dataset_urls), False
+    )
+    monkeypatch.setattr(modisdatafetcher, "source", "AQUA_MODIS", False)
+    monkeypatch.setattr(modisdatafetcher, "variable", "CHL", False)
+    return local_dataset_urls
+
+
+def test_save_dataset_log10_round_trip(local_opendap_urls, tmp_path):
+    local_dataset_urls = local_opendap_urls
+    subset_coords = (-10, 10, -10, 10)
+    lon, lat, chl, chl_stats, time_start, time_end = get_subsetted_dataset(
+        subset_coords,
+        local_dataset_urls,
+        log10=True,
+        cache_dir=None,
+        throughput_log=None,
+    )
+    save_dataset(
+        lon,
+        lat,
+        chl,
+        time_start,
+        time_end,
+        subset_coords=subset_coords,
+        datadir=str(tmp_path / "data"),
+        chl_stats=chl_stats,
+    )
+
+    (filename,) = (tmp_path / "data").glob("*.nc")
+    ds = nc.Dataset(filename)
+    saved = ds["chl"][:]
+    # only the pixel outside the source valid range is masked: log10 values
+    # below the (linear) valid_min of 0.001 are kept
+    assert np.ma.count_masked(saved, axis=(1, 2)).tolist() == [1, 1]
+    assert np.ma.allclose(saved[0], np.log10(0.1))
+    assert np.ma.allclose(saved[1], np.log10(1.1))
+    assert np.isclose(ds["chl"].valid_min, -3.0)
+    assert np.isclose(ds["chl"].valid_max, 2.0)
+    assert "standard_name" not in ds["chl"].ncattrs()
+    assert ds["chl"].units == "log10(mg m^-3)"
+    ds.close()
+
+
+def test_save_dataset_without_stats(local_opendap_urls, tmp_path):
+    lon, lat, chl, chl_stats, time_start, time_end = get_subsetted_dataset(
+        (-10, 10, -10, 10), local_opendap_urls, cache_dir=None, throughput_log=None
+    )
+    save_dataset(lon, lat, chl, time_start, time_end, datadir=str(tmp_path / "data"))
+
+    (filename,) = (tmp_path / "data").glob("*.nc")
+    with nc.Dataset(filename) as ds:
+        assert np.ma.allclose(ds["chl"][:], chl)
+        assert "chl_mean" not in ds.variables
+
+
+def test_save_dataset_without_valid_data(local_opendap_urls, tmp_path):
+    subset_coords = (-10, 10, 88.5, 89.5)  # only the missing northernmost line
+    lon, lat, chl, chl_stats, time_start, time_end = get_subsetted_dataset(
+        subset_coords, local_opendap_urls, cache_dir=None, throughput_log=None
+    )
+    assert chl.count() == 0
+    save_dataset(
+        lon,
+        lat,
+        chl,
+        time_start,
+        time_end,
+        subset_coords=subset_coords,
+        datadir=str(tmp_path / "data"),
+        chl_stats=chl_stats,
+    )
+
+    (filename,) = (tmp_path / "data").glob("*.nc")
+    with nc.Dataset(filename) as ds:
+        assert np.isnan(ds.data_minimum) and np.isnan(ds.data_maximum)
+        assert ds["chl_valid_count"][:].tolist() == [0, 0]
+
+
+def test_get_subsetted_dataset_concurrent(local_dataset_urls, tmp_path):
+    throughput_log = str(tmp_path / "throughput.json")
+    serial = get_subsetted_dataset(
+        (-10, 10, -10, 10),
+        local_dataset_urls,
+        cache_dir=None,
+        throughput_log=throughput_log,
+    )
+    concurrent = get_subsetted_dataset(
+        (-10, 10, -10, 10),
+        local_dataset_urls,
+        cache_dir=None,
+        max_workers=2,
+        time_steps_per_chunk=1,
+        throughput_log=throughput_log,
+    )
+    assert np.ma.allclose(serial[2], concurrent[2])
+    assert serial[3]["valid_count"].tolist() == concurrent[3]["valid_count"].tolist()
+    assert serial[4] == concurrent[4]
+    with open(throughput_log) as f:
+        assert len(json.load(f)) == 4  # every download recorded, also from workers
+
+
+def test_get_subsetted_dataset_unreachable(local_dataset_urls, monkeypatch):
+    monkeypatch.setattr(modisdatafetcher, "_download_subset", lambda *args: None)
+    with pytest.raises(SystemExit):
+        get_subsetted_dataset((-10, 10, -10, 10), local_dataset_urls, cache_dir=None)
+
+
+def test_fetch_subset_deduplicates_concurrent_fetches(tmp_path, monkeypatch):
+    downloads = []
+    downloads_lock = threading.Lock()
+
+    def slow_download(dataset_url, chl_key, ilat, ilon, throughput_log):
+        with downloads_lock:
+            downloads.append(dataset_url)
+        time.sleep(0.5)  # long enough for all the callers to be waiting
+        return np.arange(4, dtype="f4").reshape(2, 2), "start", "end"
+
+    monkeypatch.setattr(modisdatafetcher, "_download_subset", slow_download)
+    dataset_url = "AQUA_MODIS.20211101_20211130.L3m.MO.CHL.chlor_a.4km.nc"
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        subsets = list(
+            executor.map(
+                lambda _: fetch_subset(
+                    dataset_url, "chlor_a", [0, 2], [0, 2], cache_dir=str(tmp_path)
+                ),
+                range(4),
+            )
+        )
+
+    assert downloads == [dataset_url]
+    for chl, time_start, time_end in subsets:
+        assert np.array_equal(chl, subsets[0][0])
+        assert (time_start, time_end) == ("start", "end")
+
+
+def test_fetch_subset_failed_cache_write(tmp_path, monkeypatch):
+    def download(dataset_url, chl_key, ilat, ilon, throughput_log):
+        return np.zeros((2, 2), dtype="f4"), "start", "end"
+
+    def savez(*args, **kwargs):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(modisdatafetcher, "_download_subset", download)
+    monkeypatch.setattr(modisdatafetcher.np, "savez", savez)
+    with pytest.raises(OSError):
+        fetch_subset(
+            "AQUA_MODIS.20211101_20211130.L3m.MO.CHL.chlor_a.4km.nc",
+            "chlor_a",
+            [0, 2],
+            [0, 2],
+            cache_dir=str(tmp_path),
+        )
+    assert not list(tmp_path.glob("*.tmp"))
@@ -1,4 +1,8 @@
+import json
+import multiprocessing
 import os
+import threading
+import time
 from urllib.request import urlopen
 
 import pytest
@@ -10,9 +14,23 @@ from src.modisdatafetcher.utilities import (
     check_time_res,
     check_coords,
     find_nearest,
+    find_nearest_indices,
+    group_points,
     get_filelist_command,
     get_dates,
+    get_granule_table,
+    filter_granules,
+    build_opendap_urls,
     get_dataset_keys,
+    process_chl,
+    get_grid,
+    get_subset_indices,
+    get_cache_path,
+    record_throughput,
+    get_recent_throughput,
+    acquire_lock,
+    release_lock,
+    clean_cache,
 )
 
 
@@ -71,6 +89,19 @@ def test_find_nearest():
     assert find_nearest(np.array([2, 3, 3.1, 4]), 3.5) == (2, 3.1)
 
 
+def test_find_nearest_indices():
+    lat = np.array([4, 3.1, 3, 2])
+    assert find_nearest_indices(lat, [3.5, 2.1, 10]).tolist() == [1, 3, 0]
+
+
+def test_group_points():
+    windows, window_of_point = group_points(
+        np.array([10, 12, 100]), np.array([10, 11, 50]), half_width=1, block_size=32
+    )
+    assert windows.tolist() == [[9, 14, 9, 13], [99, 102, 49, 52]]
+    assert window_of_point.tolist() == [0, 0, 1]
+
+
 def test_valid_get_filelist_command(settings_dict, tmpdir):
     curl_command = get_filelist_command(
         settings_dict["date_min"],
@@ -95,6 +126,193 @@ def test_get_dates(settings_dict):
     )
 
 
+def test_get_granule_table(settings_dict):
+    granules = get_granule_table(settings_dict["filename"])
+    assert len(granules) == 1
+    assert granules["start"][0] == np.datetime64("2021-11-01")
+    assert granules["end"][0] == np.datetime64("2021-11-30")
+    assert granules["period"][0] == "MO"
+
+
+def test_get_granule_table_day():
+    granules = get_granule_table(["AQUA_MODIS.20211101.L3m.DAY.CHL.chlor_a.4km.nc"])
+    assert granules["start"][0] == granules["end"][0] == np.datetime64("2021-11-01")
+    assert granules["period"][0] == "DAY"
+
+
+def test_get_granule_table_unexpected_name(settings_dict):
+    with pytest.raises(ValueError):
+        get_granule_table(settings_dict["filename"] + ["filelist.txt"])
+
+
+def test_filter_granules(settings_dict):
+    filenames = [
+        "AQUA_MODIS.20211201_20211231.L3m.MO.CHL.chlor_a.4km.nc",
+        "AQUA_MODIS.20211101_20211130.L3m.MO.CHL.chlor_a.4km.nc",
+        "AQUA_MODIS.20211101_20211130.L3m.MO.CHL.chlor_a.4km.nc",
+        "AQUA_MODIS.20220201_20220228.L3m.MO.CHL.chlor_a.4km.nc",
+    ]
+    granules = filter_granules(
+        get_granule_table(filenames),
+        settings_dict["date_min"],
+        settings_dict["date_max"],
+    )
+    assert np.array_equal(
+        granules["start"], np.array(["2021-11-01", "2021-12-01"], dtype="datetime64[D]")
+    )
+
+
+def test_build_opendap_urls(settings_dict):
+    granules = get_granule_table(settings_dict["filename"])
+    dataset_urls = build_opendap_urls(granules, settings_dict["space_res"])
+    assert dataset_urls == settings_dict["dataset_urls"]
+    assert build_opendap_urls(granules[:0]) == []
+
+
+def test_build_opendap_urls_day():
+    filename = "AQUA_MODIS.20211101.L3m.DAY.CHL.chlor_a.4km.nc"
+    dataset_urls = build_opendap_urls(get_granule_table([filename]))
+    assert dataset_urls == [
+        f"http://oceandata.sci.gsfc.nasa.gov/opendap/MODISA/L3SMI/2021/1101/{filename}"
+    ]
+
+
 def test_get_dataset_keys(settings_dict):
     coor1, coor2, var = get_dataset_keys(settings_dict["dataset_path"])
     assert (coor1, coor2, var) == ("lon", "lat", "chlor_a")
+
+
+def test_process_chl():
+    chl, stats = process_chl(
+        np.array([[-32767.0, 0.0001], [1.0, 1000.0]]),
+        valid_range=(0.001, 100.0),
+        log10=True,
+        percentiles=(50,),
+    )
+    assert chl.mask.tolist() == [[True, False], [False, False]]
+    assert np.allclose(chl.compressed(), [-3.0, 0.0, 2.0])
+    assert stats["valid_count"] == 3
+    assert np.isclose(stats["mean"], -1 / 3)
+    assert np.allclose(stats["percentiles"], [0.0])
+
+
+def test_get_grid():
+    lon, lat = get_grid("9km")
+    assert (len(lon), len(lat)) == (4320, 2160)
+    assert np.isclose(lon[0], -179.958333) and np.isclose(lat[0], 89.958333)
+
+
+def test_get_subset_indices(settings_dict):
+    lon, lat = get_grid(settings_dict["space_res"])
+    ilon, ilat = get_subset_indices(lon, lat, settings_dict["subset_coords"])
+    assert (ilon[1] - ilon[0], ilat[1] - ilat[0]) == (48, 48)
+
+
+def test_get_cache_path(settings_dict, tmpdir):
+    cache_path = get_cache_path(
+        tmpdir, settings_dict["dataset_urls"][0], [2520, 2568], [2640, 2688]
+    )
+    assert os.path.basename(cache_path) == (
+        "AQUA_MODIS.20211101_20211130.L3m.MO.CHL.chlor_a.4km_2520_2568_2640_2688.npz"
+    )
+
+
+def test_recent_throughput(tmpdir):
+    log_path = os.path.join(tmpdir, "throughput.json")
+    assert get_recent_throughput(log_path) is None
+    record_throughput(1000, 1.0, log_path)
+    record_throughput(3000, 1.0, log_path)
+    assert get_recent_throughput(log_path) == 2000
+    record_throughput(1000, 1.0, None)  # disabled log
+    assert get_recent_throughput(None) is None
+
+
+def _record_throughputs(log_path):
+    for _ in range(20):
+        record_throughput(1000, 1.0, log_path)
+
+
+def test_record_throughput_from_concurrent_processes(tmpdir):
+    log_path = os.path.join(tmpdir, "throughput.json")
+    processes = [
+        multiprocessing.Process(target=_record_throughputs, args=(log_path,))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    with open(log_path) as f:
+        assert len(json.load(f)) == 80  # no measurement lost
+
+
+def _hold_lock_and_exit(lock_path):
+    acquire_lock(lock_path)  # never released: the process just ends
+
+
+def test_acquire_lock(tmpdir):
+    lock_path = os.path.join(tmpdir, "subset.lock")
+    lock_fd = acquire_lock(lock_path)
+    assert acquire_lock(lock_path, blocking=False) is None  # held by lock_fd
+    release_lock(lock_fd)
+    lock_fd = acquire_lock(lock_path, blocking=False)
+    assert lock_fd is not None
+    release_lock(lock_fd)
+
+
+def test_acquire_lock_of_dead_process(tmpdir):
+    lock_path = os.path.join(tmpdir, "subset.lock")
+    process = multiprocessing.Process(target=_hold_lock_and_exit, args=(lock_path,))
+    process.start()
+    process.join()
+    lock_fd = acquire_lock(lock_path, blocking=False)
+    assert lock_fd is not None
+    release_lock(lock_fd)
+
+
+def test_acquire_lock_of_removed_file(tmpdir):
+    lock_path = os.path.join(tmpdir, "subset.lock")
+    lock_fd = acquire_lock(lock_path)
+    waiting = {}
+    waiter = threading.Thread(
+        target=lambda: waiting.update(lock_fd=acquire_lock(lock_path))
+    )
+    waiter.start()
+    time.sleep(0.2)  # long enough for the waiter to be waiting on the lock
+    os.remove(lock_path)  # as clean_cache does while holding the lock
+    release_lock(lock_fd)
+    waiter.join()
+
+    # the waiter holds the lock of the new file, which everyone else now uses
+    assert os.path.samestat(os.fstat(waiting["lock_fd"]), os.stat(lock_path))
+    assert acquire_lock(lock_path, blocking=False) is None
+    release_lock(waiting["lock_fd"])
+
+
+def test_clean_cache(tmpdir):
+    old = time.time() - 40 * 24 * 3600
+    cache_dir = str(tmpdir)
+    old_path, new_path, busy_path, failed_path = (
+        os.path.join(cache_dir, f"{name}.npz")
+        for name in ("old", "new", "busy", "failed")
+    )
+    for cache_path in (old_path, new_path, busy_path):
+        np.savez(cache_path, chl=np.zeros(1))
+        release_lock(acquire_lock(f"{cache_path}.lock"))
+    os.utime(old_path, (old, old))
+    os.utime(busy_path, (old, old))
+    release_lock(acquire_lock(f"{failed_path}.lock"))  # download failed
+    open(f"{failed_path}.123.tmp", "w").close()  # write interrupted
+
+    busy_fd = acquire_lock(f"{busy_path}.lock")  # being fetched by another job
+    assert clean_cache(cache_dir, max_age_days=30) == 1
+    release_lock(busy_fd)
+    assert sorted(os.listdir(cache_dir)) == [
+        "busy.npz",
+        "busy.npz.lock",
+        "new.npz",
+        "new.npz.lock",
+    ]
+    assert clean_cache(cache_dir, max_age_days=0) == 2
+    assert os.listdir(cache_dir) == []
+    assert clean_cache(None) == 0